@@ -6,46 +6,281 @@ PDF 网页版阅读器 - Flask 后端
 浏览器打开: http://127.0.0.1:5000
 """
 
+import atexit
 import json
 import os
 import re
+import shutil
 import sys
 import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import unquote
 
 import fitz  # pymupdf
 from dotenv import load_dotenv
 from flask import Flask, jsonify, render_template, request, send_file, abort, redirect, url_for
-from werkzeug.utils import secure_filename
+
+try:
+    import orjson  # C 实现的 JSON 编解码，无则回退标准库
+except ImportError:
+    orjson = None
 
 # 复用现有模块
-from main import extract_toc_pages, parse_toc_with_gemini, add_bookmarks
-from split_chapters import get_toc_from_bookmarks, find_top_level_chapters, sanitize_filename
+from main import extract_toc_pages, parse_toc_with_gemini, build_toc_list
+from split_chapters import find_top_level_chapters, sanitize_filename
 
 load_dotenv()
 
 app = Flask(__name__)
+# 上传上限，防止超大请求耗尽内存/磁盘
+app.config["MAX_CONTENT_LENGTH"] = 2 * 1024 * 1024 * 1024  # 2 GiB
+
+try:
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
+
+if Compress is not None:
+    # 压缩 JSON/HTML 响应（默认 mimetype 列表不含 application/pdf，
+    # PDF 流不会被重复压缩）
+    Compress(app)
+
+if orjson is not None:
+    from flask.json.provider import JSONProvider
+
+    class _OrjsonProvider(JSONProvider):
+        """让 jsonify 走 orjson，大目录树的序列化明显更快。"""
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj).decode("utf-8")
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = _OrjsonProvider(app)
+
+# 上传/下载分块大小
+_COPY_CHUNK = 1024 * 1024  # 1 MiB
 
 # 允许浏览的根目录（当前工作目录）
 BASE_DIR = os.getcwd()
-LAST_OPENED_FILE = os.path.join(BASE_DIR, ".pdf_last_opened.json")
+
+# 应用自身的元数据放在隐藏子目录里：目录签名跳过隐藏目录，
+# 写缓存/打开记录就不会改动 BASE_DIR 本身的 mtime、
+# 把刚建好的索引缓存又冲掉
+_META_DIR = os.path.join(BASE_DIR, ".pdf_reader")
+os.makedirs(_META_DIR, exist_ok=True)
+LAST_OPENED_FILE = os.path.join(_META_DIR, "last_opened.json")
+INDEX_CACHE_FILE = os.path.join(_META_DIR, "index_cache.json")
+# 旧版本把打开记录写在根目录下，读取时向后兼容
+_LEGACY_LAST_OPENED = os.path.join(BASE_DIR, ".pdf_last_opened.json")
+
+# BASE_DIR 不会变，绝对路径和前缀只算一次，_safe_path 每个请求都要用
+_BASE_ABS = os.path.abspath(BASE_DIR)
+_BASE_PREFIX = _BASE_ABS + os.sep
 
 
 def _safe_path(filepath):
     """确保路径在允许范围内，返回绝对路径。"""
     abs_path = os.path.abspath(filepath)
-    if not abs_path.startswith(os.path.abspath(BASE_DIR)):
+    if abs_path != _BASE_ABS and not abs_path.startswith(_BASE_PREFIX):
         abort(403, "Access denied")
     return abs_path
 
 
+# 扫描时跳过的目录（隐藏目录另行判断）
+_SKIP_DIRS = ('__pycache__', 'node_modules', 'static', 'templates')
+
+# 书名中需要去掉的工具产生的后缀
+_TOC_SUFFIX_RE = re.compile(r'_toc$')
+
+
+def _iter_pdfs(base):
+    """用 os.scandir 递归遍历 base 下的 PDF 文件，逐个 yield 绝对路径。
+
+    相比 os.walk，直接复用 readdir 返回的 d_type 信息，避免对每个
+    文件额外 stat 一次。
+    """
+    stack = [base]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                name = entry.name
+                if name.startswith('.'):
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                if is_dir:
+                    if name not in _SKIP_DIRS:
+                        stack.append(entry.path)
+                elif name.lower().endswith('.pdf'):
+                    yield entry.path
+
+
+# 已打开的 fitz.Document 缓存：abs_path -> (doc, st_mtime_ns, st_size)
+# 命中时省去整本 PDF 的 xref 解析（大书可达上百毫秒）。
+# fitz.Document 不是线程安全的：使用缓存句柄必须先持有该路径的锁
+# （见 _doc_lock），淘汰/失效关闭句柄时同样要拿到锁
+_DOC_CACHE_MAX = 8
+_doc_cache = OrderedDict()
+_doc_cache_lock = threading.Lock()
+_doc_locks = {}  # abs_path -> RLock；路径数有限，不回收
+
+
+def _doc_lock(abs_path):
+    """返回某个 PDF 路径对应的可重入锁，使用缓存句柄期间必须持有。"""
+    with _doc_cache_lock:
+        lock = _doc_locks.get(abs_path)
+        if lock is None:
+            lock = threading.RLock()
+            _doc_locks[abs_path] = lock
+    return lock
+
+
+def _get_doc(abs_path):
+    """返回缓存的 fitz.Document；文件已变化则重新打开。
+
+    调用方必须持有 _doc_lock(abs_path)，并在用完之前不释放；
+    不要 close 返回的句柄。
+    """
+    st = os.stat(abs_path)
+    with _doc_cache_lock:
+        entry = _doc_cache.get(abs_path)
+        if entry and entry[1] == st.st_mtime_ns and entry[2] == st.st_size:
+            _doc_cache.move_to_end(abs_path)
+            return entry[0]
+        if entry:
+            del _doc_cache[abs_path]
+            # 调用方持有本路径的锁，旧句柄此刻无人使用
+            entry[0].close()
+    doc = fitz.open(abs_path)
+    with _doc_cache_lock:
+        _doc_cache[abs_path] = (doc, st.st_mtime_ns, st.st_size)
+        _doc_cache.move_to_end(abs_path)
+        while len(_doc_cache) > _DOC_CACHE_MAX:
+            victim_path, victim = _doc_cache.popitem(last=False)
+            victim_lock = _doc_locks.get(victim_path)
+            if victim_lock is not None and not victim_lock.acquire(blocking=False):
+                # 有线程正在使用该句柄：放回队头，缓存暂时超限
+                _doc_cache[victim_path] = victim
+                _doc_cache.move_to_end(victim_path, last=False)
+                break
+            try:
+                victim[0].close()
+            finally:
+                if victim_lock is not None:
+                    victim_lock.release()
+    return doc
+
+
+def _invalidate_doc(abs_path):
+    """写入磁盘后调用：关闭并移除缓存中的旧 Document。"""
+    with _doc_lock(abs_path):
+        with _doc_cache_lock:
+            entry = _doc_cache.pop(abs_path, None)
+        if entry:
+            entry[0].close()
+
+
+# 目录列表缓存：sig 为各目录 mtime 快照，files 为扫描结果
+_INDEX_CACHE = {"sig": None, "files": None}
+
+
+def _tree_signature(base):
+    """收集 base 及各子目录的 (路径, st_mtime_ns)，作为缓存失效签名。
+
+    目录内容（新增/删除/改名文件）变化必然更新目录 mtime，因此只需
+    O(目录数) 次 stat 即可判断整棵树的 PDF 列表是否仍有效。
+    """
+    try:
+        sig = [(base, os.stat(base).st_mtime_ns)]
+    except OSError:
+        return []
+    stack = [base]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                name = entry.name
+                if name.startswith('.') or name in _SKIP_DIRS:
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        # DirEntry.stat 复用 scandir 已取回的信息，
+                        # 不再对每个子目录单独 os.stat 一次
+                        st = entry.stat(follow_symlinks=False)
+                        sig.append((entry.path, st.st_mtime_ns))
+                        stack.append(entry.path)
+                except OSError:
+                    continue
+    sig.sort()
+    return sig
+
+
+def _read_json_file(path):
+    """读取 JSON 文件（优先 orjson）。"""
+    with open(path, "rb") as f:
+        data = f.read()
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _write_json_file(path, obj, indent=False):
+    """原子写入 JSON 文件（优先 orjson）。"""
+    if orjson is not None:
+        payload = orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    else:
+        payload = json.dumps(obj, ensure_ascii=False,
+                             indent=2 if indent else None).encode("utf-8")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+
+def _load_index_cache(sig):
+    """从磁盘缓存读取扫描结果；签名不匹配时返回 None。"""
+    try:
+        data = _read_json_file(INDEX_CACHE_FILE)
+        if data.get("sig") == [list(s) for s in sig]:
+            return data["files"]
+    except Exception:
+        pass
+    return None
+
+
+def _save_index_cache(sig, files):
+    """将扫描结果写入磁盘缓存，便于重启后直接命中。"""
+    try:
+        _write_json_file(INDEX_CACHE_FILE, {"sig": sig, "files": files})
+    except OSError:
+        pass
+
+
 def _load_last_opened():
     """读取最近打开时间记录。"""
-    if not os.path.exists(LAST_OPENED_FILE):
-        return {}
+    path = LAST_OPENED_FILE
+    if not os.path.exists(path):
+        path = _LEGACY_LAST_OPENED
+        if not os.path.exists(path):
+            return {}
     try:
-        with open(LAST_OPENED_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = _read_json_file(path)
         return data if isinstance(data, dict) else {}
     except Exception:
         return {}
@@ -53,17 +288,58 @@ def _load_last_opened():
 
 def _save_last_opened(data):
     """写入最近打开时间记录。"""
-    tmp_path = LAST_OPENED_FILE + ".tmp"
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    os.replace(tmp_path, LAST_OPENED_FILE)
+    _write_json_file(LAST_OPENED_FILE, data, indent=True)
+
+
+def _prune_last_opened(valid_rel_paths):
+    """删除指向已不存在文件的打开记录。
+
+    文件删掉后记录不会自动消失，放任不管会无限累积；
+    重建索引列表时手里正好有全量 relpath 集合，顺手清理。
+    """
+    with _last_opened_lock:
+        data = _load_last_opened()
+        stale = [rel for rel in data if rel not in valid_rel_paths]
+        if not stale:
+            return
+        for rel in stale:
+            del data[rel]
+        _save_last_opened(data)
+
+
+# 最近打开时间的待写队列：多次打开合并为一次磁盘写
+_LAST_OPENED_FLUSH_DELAY = 2.0  # 秒
+_last_opened_lock = threading.Lock()
+_last_opened_pending = {}
+_last_opened_timer = None
+
+
+def _flush_last_opened():
+    """把待写的打开时间合并落盘（后台定时器/退出时调用）。"""
+    global _last_opened_timer
+    with _last_opened_lock:
+        pending = dict(_last_opened_pending)
+        _last_opened_pending.clear()
+        _last_opened_timer = None
+    if not pending:
+        return
+    data = _load_last_opened()
+    data.update(pending)
+    _save_last_opened(data)
+
+
+atexit.register(_flush_last_opened)
 
 
 def _record_last_opened(rel_path):
-    """记录某个 PDF 的最近打开时间。"""
-    data = _load_last_opened()
-    data[rel_path] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    _save_last_opened(data)
+    """记录某个 PDF 的最近打开时间（延迟合并写入）。"""
+    global _last_opened_timer
+    with _last_opened_lock:
+        _last_opened_pending[rel_path] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if _last_opened_timer is None:
+            _last_opened_timer = threading.Timer(_LAST_OPENED_FLUSH_DELAY, _flush_last_opened)
+            _last_opened_timer.daemon = True
+            _last_opened_timer.start()
 
 
 # ──────────────────────────────────────────────
@@ -74,40 +350,70 @@ def _record_last_opened(rel_path):
 def index():
     """首页：列出当前目录及子目录下的 PDF 文件。"""
     last_opened_map = _load_last_opened()
-    seen = set()
+    # 合并尚未落盘的打开记录，页面不受延迟写影响
+    with _last_opened_lock:
+        last_opened_map.update(_last_opened_pending)
+
+    sig = _tree_signature(BASE_DIR)
+    rel_paths = _INDEX_CACHE["files"] if sig == _INDEX_CACHE["sig"] else None
+    if rel_paths is None:
+        # 进程内缓存未命中时先尝试磁盘缓存（重启后仍可命中）
+        rel_paths = _load_index_cache(sig)
+    if rel_paths is None:
+        decorated = []
+        # _iter_pdfs 每个路径只产出一次，无需再做 seen 去重
+        for full in _iter_pdfs(BASE_DIR):
+            rel = os.path.relpath(full, BASE_DIR)
+            # decorate-sort-undecorate：排序键只算一次，不走 key= 回调
+            decorated.append((
+                os.path.basename(rel).casefold(),
+                os.path.dirname(rel).casefold(),
+                rel.casefold(),
+                rel,
+            ))
+        decorated.sort()
+        rel_paths = [item[3] for item in decorated]
+        _save_index_cache(sig, rel_paths)
+        _prune_last_opened(set(rel_paths))
+    _INDEX_CACHE["sig"] = sig
+    _INDEX_CACHE["files"] = rel_paths
+
     pdf_files = []
-    for root, dirs, files in os.walk(BASE_DIR):
-        # 跳过隐藏目录和常见非目标目录
-        dirs[:] = [d for d in dirs if not d.startswith('.') and d not in ('__pycache__', 'node_modules', 'static', 'templates')]
-        for f in sorted(files):
-            if f.lower().endswith('.pdf'):
-                full = os.path.join(root, f)
-                rel = os.path.relpath(full, BASE_DIR)
-                # 同一路径文件只显示一次（防御性去重）
-                if rel in seen:
-                    continue
-                seen.add(rel)
-                folder_rel = os.path.dirname(rel)
-                pdf_files.append({
-                    "relpath": rel,
-                    "name": os.path.basename(rel),
-                    "folder": folder_rel if folder_rel and folder_rel != "." else "根目录",
-                    "last_opened": last_opened_map.get(rel, "未打开"),
-                })
-    pdf_files.sort(key=lambda x: (x["name"].lower(), x["folder"].lower(), x["relpath"].lower()))
+    for rel in rel_paths:
+        folder_rel = os.path.dirname(rel)
+        last = last_opened_map.get(rel)
+        if last is None:
+            # 从未打开过的文件回退显示其修改时间，列表里不再是
+            # 一排没有信息量的"未打开"
+            try:
+                mtime = os.stat(os.path.join(BASE_DIR, rel)).st_mtime
+                last = datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S")
+            except OSError:
+                last = "未打开"
+        pdf_files.append({
+            "relpath": rel,
+            "name": os.path.basename(rel),
+            "folder": folder_rel if folder_rel and folder_rel != "." else "根目录",
+            "last_opened": last,
+        })
     return render_template("index.html", pdf_files=pdf_files)
 
 
-@app.route("/upload", methods=["POST"])
-def upload():
-    """上传本地 PDF 文件。"""
-    if "file" not in request.files:
-        return "No file uploaded", 400
-    f = request.files["file"]
-    if not f.filename or not f.filename.lower().endswith(".pdf"):
-        return "请上传 PDF 文件", 400
-    filename = secure_filename(f.filename)
-    # 避免覆盖：若同名文件已存在则加序号
+def _safe_pdf_name(raw_name):
+    """把用户提供的文件名清理成安全的 PDF 文件名；非 PDF 返回 None。
+
+    不用 werkzeug 的 secure_filename：它会剥掉所有非 ASCII 字符，
+    中文书名（如 深度学习.pdf）会被清成 "pdf"；sanitize_filename
+    保留 Unicode，只替换路径分隔符等非法字符。
+    """
+    name = os.path.basename(raw_name)
+    if not name.lower().endswith(".pdf"):
+        return None
+    return sanitize_filename(name[:-4]) + ".pdf"
+
+
+def _unique_save_path(filename):
+    """避免覆盖：若同名文件已存在则加序号，返回 (文件名, 绝对路径)。"""
     save_path = os.path.join(BASE_DIR, filename)
     base, ext = os.path.splitext(filename)
     counter = 1
@@ -115,10 +421,56 @@ def upload():
         filename = f"{base}_{counter}{ext}"
         save_path = os.path.join(BASE_DIR, filename)
         counter += 1
+    return filename, save_path
+
+
+@app.route("/upload", methods=["POST"])
+def upload():
+    """上传本地 PDF 文件（multipart 表单回退路径）。
+
+    multipart 请求体在视图运行前已被 werkzeug 缓冲到临时文件，
+    这里省不掉二次写；前端正常走 /upload-stream。
+    """
+    if "file" not in request.files:
+        return "No file uploaded", 400
+    f = request.files["file"]
+    filename = _safe_pdf_name(f.filename) if f.filename else None
+    if filename is None:
+        return "请上传 PDF 文件", 400
+    filename, save_path = _unique_save_path(filename)
     f.save(save_path)
+    _INDEX_CACHE["sig"] = None  # 目录已变化，强制下次重建列表
     return redirect(url_for("reader", file=filename))
 
 
+@app.route("/upload-stream", methods=["POST"])
+def upload_stream():
+    """流式上传：请求体即 PDF 字节流，文件名取自 X-Filename 头。
+
+    不走 multipart，字节从 socket 一次写到目标文件，
+    没有临时文件的第二次拷贝。
+    """
+    filename = _safe_pdf_name(unquote(request.headers.get("X-Filename", "")))
+    if filename is None:
+        return "请通过 X-Filename 头指定 PDF 文件名", 400
+    filename, save_path = _unique_save_path(filename)
+    # 先写临时名，收完再原子改名：客户端中途断开不会在最终
+    # 文件名下留下半截 PDF 被首页当成一本书列出来
+    tmp_path = save_path + ".part"
+    try:
+        with open(tmp_path, "wb") as out:
+            shutil.copyfileobj(request.stream, out, length=_COPY_CHUNK)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.replace(tmp_path, save_path)
+    _INDEX_CACHE["sig"] = None
+    return jsonify({"success": True, "file": filename})
+
+
 @app.route("/reader")
 def reader():
     """阅读器页面。"""
@@ -143,11 +495,27 @@ def api_pdf():
     abs_path = _safe_path(os.path.join(BASE_DIR, filepath))
     if not os.path.isfile(abs_path):
         abort(404)
-    resp = send_file(abs_path, mimetype="application/pdf")
-    resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    # conditional=True: 带 ETag/Last-Modified 并支持 Range 请求，
+    # 未变化的文件直接返回 304，pdf.js 也能按需取字节区间
+    resp = send_file(abs_path, mimetype="application/pdf", conditional=True)
+    resp.headers["Cache-Control"] = "no-cache"
     return resp
 
 
+# flask-compress 会把压缩响应的 ETag 改写成 "<etag>:<算法>"，但不会
+# 还原浏览器回传的 If-None-Match，比较时两种形式都要认，
+# 否则大于压缩阈值的响应永远 304 不了
+_COMPRESS_ALGS = ("br", "gzip", "deflate", "zstd")
+
+
+def _etag_matches(etag):
+    """判断请求的 If-None-Match 是否命中 etag（含压缩算法后缀变体）。"""
+    inm = request.if_none_match
+    if inm.contains(etag):
+        return True
+    return any(inm.contains(f"{etag}:{alg}") for alg in _COMPRESS_ALGS)
+
+
 @app.route("/api/outline")
 def api_outline():
     """获取 PDF 的 outline/bookmarks，返回树形结构。"""
@@ -156,25 +524,38 @@ def api_outline():
     if not os.path.isfile(abs_path):
         abort(404)
 
-    doc = fitz.open(abs_path)
-    toc = doc.get_toc()  # [[level, title, page], ...]
-    doc.close()
+    # outline 只随文件内容变化，用 mtime+size 做 ETag，
+    # 未变化时直接 304，省去 get_toc 和整棵树的序列化
+    st = os.stat(abs_path)
+    etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+    if _etag_matches(etag):
+        return "", 304
+
+    with _doc_lock(abs_path):
+        doc = _get_doc(abs_path)
+        toc = doc.get_toc()  # [[level, title, page], ...]
 
-    # 构建树形结构
+    # 构建树形结构：单趟扫描，levels/children 两个平行栈
+    # 避免每个节点构造和解包 (level, children) 元组
     def build_tree(flat_toc):
         root = []
-        stack = [(0, root)]  # (level, children_list)
+        levels = [0]
+        children = [root]
         for level, title, page in flat_toc:
             node = {"title": title, "page": page, "level": level, "children": []}
             # 找到合适的父节点
-            while len(stack) > 1 and stack[-1][0] >= level:
-                stack.pop()
-            stack[-1][1].append(node)
-            stack.append((level, node["children"]))
+            while len(levels) > 1 and levels[-1] >= level:
+                levels.pop()
+                children.pop()
+            children[-1].append(node)
+            levels.append(level)
+            children.append(node["children"])
         return root
 
     tree = build_tree(toc)
-    return jsonify({"outline": tree, "total": len(toc)})
+    resp = jsonify({"outline": tree, "total": len(toc)})
+    resp.set_etag(etag)
+    return resp
 
 
 @app.route("/api/extract-toc", methods=["POST"])
@@ -205,9 +586,64 @@ def api_extract_toc():
     return jsonify({"tocPdf": toc_rel})
 
 
+# Gemini 解析任务表：job_id -> {"status": "running"/"done"/"error", "ts": ...}
+# 已结束的任务轮询一次即删；标签页被关掉没人来轮询的，
+# 超过 TTL 后在新任务创建时清掉
+_toc_jobs = {}
+_toc_jobs_lock = threading.Lock()
+_TOC_JOB_TTL = 3600  # 秒
+
+
+def _run_add_toc_job(job_id, abs_path, toc_pdf_path, page_offset, api_key):
+    """后台线程：Gemini 解析目录并写入书签。"""
+    try:
+        # Step 1: Gemini 解析
+        toc_data = parse_toc_with_gemini(toc_pdf_path, api_key, "gemini-2.5-flash")
+
+        # Step 2: 添加书签。在私有句柄上 set_toc，不改缓存里的
+        # Document：写盘中途失败时，缓存不会残留一份磁盘上
+        # 并不存在的 outline；只改 outline 字典时用增量保存，
+        # 追加变更对象即可。
+        doc = fitz.open(abs_path)
+        try:
+            toc_list = build_toc_list(toc_data, page_offset, len(doc))
+            doc.set_toc(toc_list)
+            # 持路径锁写盘，避免与正在读缓存句柄的请求线程交错
+            with _doc_lock(abs_path):
+                if doc.can_save_incrementally():
+                    doc.save(abs_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+                else:
+                    # 线性化/加密等不支持增量的情况回退到完整重写。
+                    # 只改 outline 不产生垃圾对象，跳过 garbage 回收和
+                    # 全量重新压缩，重写成本只剩顺序拷贝
+                    tmp_out = abs_path + ".tmp"
+                    doc.save(tmp_out, garbage=0, deflate=False)
+                    os.replace(tmp_out, abs_path)
+        finally:
+            doc.close()
+            # 无论成败都失效缓存：磁盘可能已（部分）变化，
+            # 后续请求一律按当前文件内容重新打开
+            _invalidate_doc(abs_path)
+
+        # Step 3: 删除临时目录 PDF
+        os.remove(toc_pdf_path)
+
+        result = {"status": "done", "tocCount": len(toc_data["toc"])}
+    except Exception as e:
+        result = {"status": "error", "error": str(e)}
+
+    result["ts"] = time.time()
+    with _toc_jobs_lock:
+        _toc_jobs[job_id] = result
+
+
 @app.route("/api/add-toc", methods=["POST"])
 def api_add_toc():
-    """Gemini 解析目录 + 添加书签到原 PDF。"""
+    """启动后台任务：Gemini 解析目录 + 添加书签到原 PDF。
+
+    Gemini 调用动辄几十秒，不再阻塞请求线程（也不占用 worker），
+    立即返回 job id，前端轮询 /api/add-toc-status 获取结果。
+    """
     data = request.get_json()
     filepath = data.get("file", "")
     toc_pdf_rel = data.get("tocPdf", "")
@@ -225,22 +661,35 @@ def api_add_toc():
     if not api_key:
         return jsonify({"error": "未配置 GEMINI_API_KEY"}), 500
 
-    try:
-        # Step 1: Gemini 解析
-        toc_data = parse_toc_with_gemini(toc_pdf_path, api_key, "gemini-2.5-flash")
-
-        # Step 2: 添加书签（先写临时文件再替换原文件）
-        tmp_out = abs_path + ".tmp"
-        add_bookmarks(abs_path, toc_data, tmp_out, int(page_offset))
-        os.replace(tmp_out, abs_path)
-
-        # Step 3: 删除临时目录 PDF
-        os.remove(toc_pdf_path)
-
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-    return jsonify({"success": True, "tocCount": len(toc_data["toc"])})
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _toc_jobs_lock:
+        # 顺手清理无人轮询的过期结果
+        stale = [jid for jid, job in _toc_jobs.items()
+                 if job["status"] != "running" and now - job["ts"] > _TOC_JOB_TTL]
+        for jid in stale:
+            del _toc_jobs[jid]
+        _toc_jobs[job_id] = {"status": "running", "ts": now}
+    threading.Thread(
+        target=_run_add_toc_job,
+        args=(job_id, abs_path, toc_pdf_path, int(page_offset), api_key),
+        daemon=True,
+    ).start()
+    return jsonify({"jobId": job_id})
+
+
+@app.route("/api/add-toc-status")
+def api_add_toc_status():
+    """查询后台目录解析任务状态。"""
+    job_id = request.args.get("job", "")
+    with _toc_jobs_lock:
+        job = _toc_jobs.get(job_id)
+        # 已结束的任务取走即删，任务表不会无限增长
+        if job is not None and job["status"] != "running":
+            del _toc_jobs[job_id]
+    if job is None:
+        return jsonify({"error": "未知任务"}), 404
+    return jsonify({k: v for k, v in job.items() if k != "ts"})
 
 
 @app.route("/api/top-chapters")
@@ -251,14 +700,25 @@ def api_top_chapters():
     if not os.path.isfile(abs_path):
         abort(404)
 
-    toc = get_toc_from_bookmarks(abs_path)
-    if not toc:
-        return jsonify({"chapters": [], "error": "PDF 中没有书签"})
+    # 章节列表同样只随文件内容变化，与 /api/outline 相同的
+    # mtime+size ETag，未变化时省去 get_toc 和章节筛选
+    st = os.stat(abs_path)
+    etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+    if _etag_matches(etag):
+        return "", 304
 
-    chapters = find_top_level_chapters(toc)
-    return jsonify({
-        "chapters": [{"title": c["title"], "page": c["page"]} for c in chapters]
-    })
+    with _doc_lock(abs_path):
+        raw_toc = _get_doc(abs_path).get_toc()
+    toc = [{"level": item[0], "title": item[1], "page": item[2]} for item in raw_toc]
+    if not toc:
+        resp = jsonify({"chapters": [], "error": "PDF 中没有书签"})
+    else:
+        chapters = find_top_level_chapters(toc)
+        resp = jsonify({
+            "chapters": [{"title": c["title"], "page": c["page"]} for c in chapters]
+        })
+    resp.set_etag(etag)
+    return resp
 
 
 @app.route("/api/split-chapters", methods=["POST"])
@@ -275,19 +735,20 @@ def api_split_chapters():
     if not selected:
         return jsonify({"error": "未选择任何章节"}), 400
 
-    doc = fitz.open(abs_path)
-    total_pages = len(doc)
+    with _doc_lock(abs_path):
+        total_pages = len(_get_doc(abs_path))
 
     # 创建输出文件夹
     book_name = os.path.splitext(os.path.basename(abs_path))[0]
-    book_name = re.sub(r'_toc$', '', book_name)
+    book_name = _TOC_SUFFIX_RE.sub('', book_name)
     output_dir = os.path.join(os.path.dirname(abs_path), book_name)
     os.makedirs(output_dir, exist_ok=True)
 
     # 按页码排序
     selected.sort(key=lambda c: c["page"])
 
-    results = []
+    # 先串行算好各章页码区间，写出阶段再并行
+    jobs = []
     for i, chapter in enumerate(selected):
         start_page = chapter["page"]
         if i + 1 < len(selected):
@@ -297,18 +758,36 @@ def api_split_chapters():
 
         start_page = max(1, min(start_page, total_pages))
         end_page = max(start_page, min(end_page, total_pages))
-
-        filename = sanitize_filename(chapter["title"]) + ".pdf"
+        jobs.append((chapter["title"], start_page, end_page))
+
+    # fitz.Document 不是线程安全的，不能共享缓存句柄；但按 worker
+    # 线程（threading.local）而不是按章节打开源文件，多少章都只付
+    # worker 数次 xref 解析。句柄跨章节复用，所以不能用会就地裁剪
+    # 页树的 select，改用 insert_pdf 拷进新文档
+    tls = threading.local()
+    worker_docs = []
+
+    def write_chapter(job):
+        title, start_page, end_page = job
+        filename = sanitize_filename(title) + ".pdf"
         output_path = os.path.join(output_dir, filename)
-
+        src = getattr(tls, "doc", None)
+        if src is None:
+            src = tls.doc = fitz.open(abs_path)
+            worker_docs.append(src)
         new_doc = fitz.open()
-        new_doc.insert_pdf(doc, from_page=start_page - 1, to_page=end_page - 1)
-        new_doc.save(output_path)
+        new_doc.insert_pdf(src, from_page=start_page - 1, to_page=end_page - 1)
+        # insert_pdf 只拷贝被引用的对象，无需 garbage 回收；
+        # 跳过重新压缩，章节流沿用原书已压缩的数据
+        new_doc.save(output_path, garbage=0, deflate=False)
         new_doc.close()
+        return {"title": title, "file": filename, "pages": f"{start_page}-{end_page}"}
 
-        results.append({"title": chapter["title"], "file": filename, "pages": f"{start_page}-{end_page}"})
-
-    doc.close()
+    max_workers = min(len(jobs), os.cpu_count() or 2, 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(write_chapter, jobs))
+    for src in worker_docs:
+        src.close()
 
     return jsonify({
         "success": True,
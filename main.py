@@ -11,14 +11,71 @@ PDF 书籍目录提取与书签添加工具
 import argparse
 import json
 import os
+import re
+import shutil
 import sys
 import time
 
 import fitz  # pymupdf
 from dotenv import load_dotenv
 
+try:
+    import orjson  # C 实现的 JSON 编解码，无则回退标准库
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec  # C 层一次完成 JSON 解析 + 结构校验，无则回退纯 Python
+except ImportError:
+    msgspec = None
+
 load_dotenv()
 
+if msgspec is not None:
+    class _TocItem(msgspec.Struct):
+        level: int
+        title: str
+        page: int
+
+    class _TocData(msgspec.Struct):
+        toc: list[_TocItem]
+
+
+def _validate_toc_json(text: str) -> dict:
+    """解析并校验 Gemini 返回的目录 JSON，返回 {"toc": [...]}。"""
+    if msgspec is not None:
+        try:
+            data = msgspec.json.decode(text, type=_TocData)
+        except msgspec.DecodeError as e:
+            raise ValueError(f"Gemini 返回的 JSON 无效: {e}")
+        return msgspec.to_builtins(data)
+
+    toc_data = json.loads(text)
+
+    # 基本校验
+    if "toc" not in toc_data or not isinstance(toc_data["toc"], list):
+        raise ValueError("Gemini 返回的 JSON 缺少 toc 数组")
+    for i, item in enumerate(toc_data["toc"]):
+        for key in ("level", "title", "page"):
+            if key not in item:
+                raise ValueError(f"toc[{i}] 缺少字段: {key}")
+    return toc_data
+
+
+def save_toc_json(path: str, toc_data: dict):
+    """写出目录 JSON。
+
+    优先 orjson：一次性编码 UTF-8 字节直接落盘，省去标准库
+    逐块生成 str 再经 TextIOWrapper 编码的开销；保留 2 空格缩进，
+    文件仍便于人工检查和修改。
+    """
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(toc_data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(toc_data, f, ensure_ascii=False, indent=2)
+
 # ──────────────────────────────────────────────
 # Step 1: 提取目录页
 # ──────────────────────────────────────────────
@@ -31,10 +88,10 @@ def extract_toc_pages(input_pdf: str, start_page: int, end_page: int, output_pdf
         doc.close()
         raise ValueError(f"页码范围无效: {start_page}-{end_page}（PDF 共 {total} 页）")
 
-    new_doc = fitz.open()
-    new_doc.insert_pdf(doc, from_page=start_page - 1, to_page=end_page - 1)
-    new_doc.save(output_pdf)
-    new_doc.close()
+    # select 只裁剪页树，不像 insert_pdf 那样逐对象拷贝进新文档；
+    # garbage=1 在保存时丢弃整本书里不再被引用的对象
+    doc.select(list(range(start_page - 1, end_page)))
+    doc.save(output_pdf, garbage=1)
     doc.close()
     print(f"[Step 1] 已提取第 {start_page}-{end_page} 页 → {output_pdf}")
 
@@ -62,43 +119,65 @@ GEMINI_PROMPT = """\
 """
 
 
-def parse_toc_with_gemini(toc_pdf_path: str, api_key: str, model_name: str) -> dict:
-    """上传目录 PDF 到 Gemini，返回结构化目录 dict。"""
-    import google.generativeai as genai
+# 去掉包裹 JSON 的 markdown 代码块标记（```json ... ```）
+_JSON_FENCE_RE = re.compile(r'^```[^\n]*\n?|```\s*$')
+
+# 已配置的 google.generativeai 模块单例
+_genai = None
+
+
+def _get_genai(api_key: str):
+    """延迟导入并配置一次 google.generativeai，后续调用直接复用。"""
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        _genai = genai
+    return _genai
+
 
-    genai.configure(api_key=api_key)
+def upload_toc_pdf(toc_pdf_path: str, api_key: str):
+    """上传目录 PDF 并等待服务端处理完成，返回 Gemini 文件句柄。
 
-    print("[Step 3] 正在上传 PDF 到 Gemini...")
+    单独成函数且不打印任何输出：workflow 在人工确认目录页的同时
+    于后台线程调用它，不能让进度输出冲掉终端里的确认提示。
+    """
+    genai = _get_genai(api_key)
     uploaded = genai.upload_file(toc_pdf_path, mime_type="application/pdf")
 
-    # 等待文件处理完成
+    # 等待文件处理完成：指数退避轮询，小文件几百毫秒就绪时
+    # 不用白等固定 2 秒，大文件也不会高频打接口
+    delay = 0.5
     while uploaded.state.name == "PROCESSING":
-        time.sleep(2)
+        time.sleep(delay)
+        delay = min(delay * 1.5, 5.0)
         uploaded = genai.get_file(uploaded.name)
 
     if uploaded.state.name == "FAILED":
         raise RuntimeError(f"Gemini 文件处理失败: {uploaded.state.name}")
+    return uploaded
+
+
+def parse_toc_with_gemini(toc_pdf_path: str, api_key: str, model_name: str,
+                          uploaded=None) -> dict:
+    """上传目录 PDF 到 Gemini，返回结构化目录 dict。
+
+    uploaded: 已经由 upload_toc_pdf 上传好的文件句柄，传入则跳过上传。
+    """
+    genai = _get_genai(api_key)
+
+    if uploaded is None:
+        print("[Step 3] 正在上传 PDF 到 Gemini...")
+        uploaded = upload_toc_pdf(toc_pdf_path, api_key)
 
     print(f"[Step 3] 文件已上传，使用模型 {model_name} 解析中...")
     model = genai.GenerativeModel(model_name)
     response = model.generate_content([uploaded, GEMINI_PROMPT])
 
-    # 清理可能的 markdown 代码块标记
-    text = response.text.strip()
-    if text.startswith("```"):
-        text = text.split("\n", 1)[1]  # 去掉第一行 ```json
-    if text.endswith("```"):
-        text = text[:-3].strip()
+    # 清理可能的 markdown 代码块标记（首尾围栏一次 sub 去掉）
+    text = _JSON_FENCE_RE.sub('', response.text.strip()).strip()
 
-    toc_data = json.loads(text)
-
-    # 基本校验
-    if "toc" not in toc_data or not isinstance(toc_data["toc"], list):
-        raise ValueError("Gemini 返回的 JSON 缺少 toc 数组")
-    for i, item in enumerate(toc_data["toc"]):
-        for key in ("level", "title", "page"):
-            if key not in item:
-                raise ValueError(f"toc[{i}] 缺少字段: {key}")
+    toc_data = _validate_toc_json(text)
 
     # 清理上传的文件
     try:
@@ -114,33 +193,43 @@ def parse_toc_with_gemini(toc_pdf_path: str, api_key: str, model_name: str) -> d
 # Step 5: 写入书签
 # ──────────────────────────────────────────────
 
-def add_bookmarks(input_pdf: str, toc_data: dict, output_pdf: str, page_offset: int):
-    """
-    根据结构化目录向 PDF 添加书签。
+def build_toc_list(toc_data: dict, page_offset: int, total_pages: int) -> list:
+    """将结构化目录转为 set_toc 所需的 [level, title, page] 列表。
 
     page_offset: PDF 实际页码 = 印刷页码 + page_offset
     例如：印刷第 3 页 对应 PDF 第 29 页 → page_offset = 26
     """
-    doc = fitz.open(input_pdf)
-    total_pages = len(doc)
-
     toc_list = []
+    append = toc_list.append
     for item in toc_data["toc"]:
-        level = item["level"]
-        title = item["title"]
-        pdf_page = item["page"] + page_offset
+        # 页码裁剪到 [1, total_pages]，min/max 无分支跳转
+        append([item["level"], item["title"],
+                min(max(item["page"] + page_offset, 1), total_pages)])
+    return toc_list
 
-        # 确保页码在有效范围内
-        if pdf_page < 1:
-            pdf_page = 1
-        elif pdf_page > total_pages:
-            pdf_page = total_pages
 
-        toc_list.append([level, title, pdf_page])
+def add_bookmarks(input_pdf: str, toc_data: dict, output_pdf: str, page_offset: int):
+    """根据结构化目录向 PDF 添加书签。
 
+    先按字节拷贝到输出路径，再在副本上增量保存：只追加 outline
+    相关的新对象，免去整本 PDF 的重新序列化（写入量从 O(文件大小)
+    降到 O(目录大小)）。
+    """
+    if os.path.abspath(input_pdf) != os.path.abspath(output_pdf):
+        shutil.copyfile(input_pdf, output_pdf)
+
+    doc = fitz.open(output_pdf)
+    toc_list = build_toc_list(toc_data, page_offset, len(doc))
     doc.set_toc(toc_list)
-    doc.save(output_pdf)
-    doc.close()
+    if doc.can_save_incrementally():
+        doc.save(output_pdf, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        doc.close()
+    else:
+        # 线性化/加密等不支持增量的情况回退到完整重写
+        tmp_out = output_pdf + ".tmp"
+        doc.save(tmp_out, garbage=0, deflate=False)
+        doc.close()
+        os.replace(tmp_out, output_pdf)
     print(f"[Step 5] 已添加 {len(toc_list)} 条书签 → {output_pdf}")
 
 
@@ -204,8 +293,7 @@ def main():
             sys.exit(1)
 
         toc_data = parse_toc_with_gemini(args.toc_pdf, api_key, args.model)
-        with open(args.toc_json, "w", encoding="utf-8") as f:
-            json.dump(toc_data, f, ensure_ascii=False, indent=2)
+        save_toc_json(args.toc_json, toc_data)
         print(f"目录 JSON 已保存 → {args.toc_json}")
         print(f"\n请检查 {args.toc_json}，确认无误后运行 apply 步骤。")
 
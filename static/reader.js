@@ -28,7 +28,8 @@ const resizer = $("#resizer");
 // ──────────────────────────────────────────────
 async function loadPdf() {
     showLoading("正在加载 PDF...");
-    const url = `/api/pdf?file=${encodeURIComponent(FILE_PATH)}&t=${Date.now()}`;
+    // 不加时间戳参数：服务端用 ETag/304 判断文件是否变化
+    const url = `/api/pdf?file=${encodeURIComponent(FILE_PATH)}`;
     pdfDoc = await pdfjsLib.getDocument({ url, disableAutoFetch: false }).promise;
     $("#pageInfo").textContent = `共 ${pdfDoc.numPages} 页`;
     await setupPages();
@@ -206,7 +207,7 @@ zoomSelect.addEventListener("change", () => setScale(parseFloat(zoomSelect.value
 // Outline
 // ──────────────────────────────────────────────
 async function loadOutline() {
-    const resp = await fetch(`/api/outline?file=${encodeURIComponent(FILE_PATH)}&t=${Date.now()}`);
+    const resp = await fetch(`/api/outline?file=${encodeURIComponent(FILE_PATH)}`);
     const data = await resp.json();
     outlineTree.innerHTML = "";
     if (!data.outline || data.outline.length === 0) {
@@ -405,9 +406,19 @@ $("#btnConfirmAddToc").addEventListener("click", async () => {
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({ file: FILE_PATH, tocPdf: tocPdfRel, pageOffset }),
         });
-        const data = await resp.json();
+        let data = await resp.json();
         if (data.error) throw new Error(data.error);
 
+        // 解析在服务端后台执行，轮询任务状态直到完成
+        const jobId = data.jobId;
+        while (true) {
+            await new Promise((r) => setTimeout(r, 2000));
+            const poll = await fetch(`/api/add-toc-status?job=${jobId}`);
+            data = await poll.json();
+            if (data.error) throw new Error(data.error);
+            if (data.status === "done") break;
+        }
+
         status.textContent = `添加成功！共 ${data.tocCount} 条目录`;
         status.className = "status-text success";
 
@@ -10,11 +10,16 @@ PDF 章节批量总结工具
 """
 
 import argparse
-import glob
+import atexit
+import hashlib
+import json
 import os
 import re
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 
 from dotenv import load_dotenv
 
@@ -39,40 +44,270 @@ TODO: 在此填写其他类书籍的总结 prompt
 }
 
 
+# 模块级预编译，natural_sort_key 对每个文件都会调用
+_DIGITS_RE = re.compile(r'(\d+)')
+
+
+# 已配置的 google.generativeai 模块单例
+_genai = None
+
+
+def _get_genai(api_key: str):
+    """延迟导入并配置一次 google.generativeai，后续调用直接复用。
+
+    configure 会重建默认 client，逐章调用既浪费又丢掉连接复用。
+    """
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        _genai = genai
+    return _genai
+
+
+@lru_cache(maxsize=1024)
 def natural_sort_key(path: str):
-    """自然排序：按文件名中的数字排序（1, 2, 10 而非 1, 10, 2）。"""
+    """自然排序：按文件名中的数字排序（1, 2, 10 而非 1, 10, 2）。
+
+    sorted(key=...) 对每个元素只调用一次，但同一批文件会在
+    summarize 和 workflow 中反复排序，缓存能省去重复的正则拆分。
+    """
     name = os.path.basename(path)
-    return [int(c) if c.isdigit() else c.lower() for c in re.split(r'(\d+)', name)]
+    return [int(c) if c.isdigit() else c.lower() for c in _DIGITS_RE.split(name)]
+
+
+def list_chapter_pdfs(input_dir: str) -> list[str]:
+    """列出目录下的章节 PDF，按自然顺序排序。
+
+    os.scandir 直接复用 readdir 的 d_type 信息做后缀过滤，
+    不经过 glob 的模式编译和 fnmatch 匹配。
+    """
+    pdfs = []
+    with os.scandir(input_dir) as it:
+        for entry in it:
+            if entry.name.lower().endswith(".pdf") and entry.is_file(follow_symlinks=False):
+                pdfs.append(entry.path)
+    pdfs.sort(key=natural_sort_key)
+    return pdfs
 
 
-def summarize_chapter(pdf_path: str, api_key: str, model_name: str, prompt: str) -> str:
-    """上传单个章节 PDF 到 Gemini，返回 Markdown 总结文本。"""
-    import google.generativeai as genai
+# 本次运行已上传的文件：sha256 -> Gemini 文件对象。
+# 同内容的章节（重跑、重复拆分产物）直接复用，不再重复上传
+_upload_cache = {}
+_upload_cache_lock = threading.Lock()
 
-    genai.configure(api_key=api_key)
+# 跨进程复用：Gemini 文件服务端保留 48 小时，上传成功后把
+# sha256 -> 文件名 记在章节文件夹下的 sidecar 里，重跑时先
+# 找回旧句柄，整章不用再传一遍
+_SIDECAR_NAME = ".gemini_uploads.json"
+_UPLOAD_REUSE_TTL = 47 * 3600  # 秒；留 1 小时余量，避免刚好踩在过期边界上
+_sidecar_lock = threading.Lock()
+# 已写入 sidecar 的文件名：退出清理时跳过，留给之后的重跑复用
+_persisted_names = set()
 
-    uploaded = genai.upload_file(pdf_path, mime_type="application/pdf")
 
-    # 等待文件处理完成
-    while uploaded.state.name == "PROCESSING":
-        time.sleep(2)
-        uploaded = genai.get_file(uploaded.name)
+def _file_sha256(path: str) -> str:
+    """分块计算文件 SHA-256。"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
-    if uploaded.state.name == "FAILED":
-        raise RuntimeError(f"文件处理失败: {pdf_path}")
 
-    model = genai.GenerativeModel(model_name)
-    response = model.generate_content([uploaded, prompt])
+def _sidecar_path(pdf_path: str) -> str:
+    """返回某章节 PDF 所在文件夹的 sidecar 路径。"""
+    return os.path.join(os.path.dirname(os.path.abspath(pdf_path)), _SIDECAR_NAME)
 
-    # 清理上传的文件
+
+def _load_sidecar(path: str) -> dict:
+    """读取 sidecar；不存在或损坏时返回空表。"""
     try:
-        genai.delete_file(uploaded.name)
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
     except Exception:
-        pass
+        return {}
+
+
+def _reuse_upload(genai, sidecar_path: str, digest: str):
+    """按内容哈希找回之前运行上传的 Gemini 文件句柄。
 
+    条目过期、文件已被服务端清理或状态异常时返回 None，
+    调用方照常重新上传。
+    """
+    with _sidecar_lock:
+        entry = _load_sidecar(sidecar_path).get(digest)
+    if not entry or time.time() - entry.get("ts", 0) > _UPLOAD_REUSE_TTL:
+        return None
+    try:
+        uploaded = genai.get_file(entry["name"])
+    except Exception:
+        return None
+    if uploaded.state.name != "ACTIVE":
+        return None
+    _persisted_names.add(uploaded.name)
+    return uploaded
+
+
+def _record_upload(sidecar_path: str, digest: str, name: str):
+    """把 sha256 → Gemini 文件名写入 sidecar，供 48 小时内的重跑复用。"""
+    with _sidecar_lock:
+        data = _load_sidecar(sidecar_path)
+        data[digest] = {"name": name, "ts": time.time()}
+        tmp_path = sidecar_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, sidecar_path)
+        except OSError:
+            return
+    _persisted_names.add(name)
+
+
+def _cleanup_uploads():
+    """进程退出时批量删除本次运行中未持久化的上传。
+
+    已写入 sidecar 的句柄留给 48 小时内的重跑复用，到期由
+    Gemini 服务端自动清理；这里只收拾 sidecar 写入失败的漏网句柄。
+    """
+    if _genai is None:
+        return
+    with _upload_cache_lock:
+        uploads = list(_upload_cache.values())
+        _upload_cache.clear()
+    for uploaded in uploads:
+        if uploaded.name in _persisted_names:
+            continue
+        try:
+            _genai.delete_file(uploaded.name)
+        except Exception:
+            pass
+
+
+atexit.register(_cleanup_uploads)
+
+
+def build_model(api_key: str, model_name: str, prompt: str):
+    """为整个运行构建一次共享的 GenerativeModel。
+
+    prompt 作为 system_instruction 绑定在模型实例上，随每次调用
+    复用，不再逐章重建模型、重复拼接提交 prompt。（Gemini 显式
+    context caching 有最低 token 门槛，这里的 prompt 远低于门槛，
+    复用模型实例是对应的轻量做法。）
+    """
+    genai = _get_genai(api_key)
+    return genai.GenerativeModel(model_name, system_instruction=prompt)
+
+
+def summarize_chapter(pdf_path: str, api_key: str, model) -> str:
+    """上传单个章节 PDF 到 Gemini，返回 Markdown 总结文本。
+
+    上传前先按内容哈希查本次运行的上传缓存，再查磁盘 sidecar
+    （跨进程复用 48 小时内的旧上传）；未持久化的句柄统一由
+    _cleanup_uploads 在退出时清理。
+    """
+    genai = _get_genai(api_key)
+
+    digest = _file_sha256(pdf_path)
+    with _upload_cache_lock:
+        uploaded = _upload_cache.get(digest)
+
+    sidecar_path = _sidecar_path(pdf_path)
+    if uploaded is None:
+        # 进程内未命中时先查 sidecar：48 小时内的重跑直接复用旧句柄
+        uploaded = _reuse_upload(genai, sidecar_path, digest)
+        if uploaded is not None:
+            with _upload_cache_lock:
+                uploaded = _upload_cache.setdefault(digest, uploaded)
+
+    if uploaded is None:
+        uploaded = genai.upload_file(pdf_path, mime_type="application/pdf")
+
+        # 等待文件处理完成：指数退避轮询，小章节几百毫秒就绪时
+        # 不用白等固定 2 秒，大章节也不会高频打接口
+        delay = 0.5
+        while uploaded.state.name == "PROCESSING":
+            time.sleep(delay)
+            delay = min(delay * 1.5, 5.0)
+            uploaded = genai.get_file(uploaded.name)
+
+        if uploaded.state.name == "FAILED":
+            raise RuntimeError(f"文件处理失败: {pdf_path}")
+
+        # 并发下两个线程可能同时未命中、各自上传了同一份内容：
+        # 回写前再查一次，输掉的一方删除自己的冗余上传并复用
+        # 已缓存的句柄，否则被覆盖的句柄会永远留在 Gemini 上
+        redundant = None
+        with _upload_cache_lock:
+            existing = _upload_cache.get(digest)
+            if existing is None:
+                _upload_cache[digest] = uploaded
+            else:
+                redundant = uploaded
+                uploaded = existing
+        if redundant is not None:
+            try:
+                genai.delete_file(redundant.name)
+            except Exception:
+                pass
+        else:
+            _record_upload(sidecar_path, digest, uploaded.name)
+
+    response = model.generate_content([uploaded])
     return response.text
 
 
+def run_summaries(pdf_files, output_dir, api_key, model_name, prompt,
+                  start_from=1, max_workers=4):
+    """并发逐章总结；已有 .md 自动跳过。返回失败的文件名列表。
+
+    总结是网络 I/O 密集（上传 + 等待 Gemini），用少量线程并发
+    可把总耗时压到接近最慢一章，而不是所有章节之和。
+    """
+    total = len(pdf_files)
+    jobs = []
+    for i, pdf_path in enumerate(pdf_files, start=1):
+        filename = os.path.basename(pdf_path)
+        md_name = os.path.splitext(filename)[0] + ".md"
+        md_path = os.path.join(output_dir, md_name)
+
+        # 跳过断点续传之前的文件
+        if i < start_from:
+            print(f"  [{i}/{total}] 跳过: {filename}")
+            continue
+
+        # 跳过已存在的总结
+        if os.path.isfile(md_path):
+            print(f"  [{i}/{total}] 已存在，跳过: {md_name}")
+            continue
+
+        jobs.append((i, pdf_path, filename, md_path))
+
+    failures = []
+    if not jobs:
+        return failures
+
+    model = build_model(api_key, model_name, prompt)
+
+    def work(job):
+        _, pdf_path, _, md_path = job
+        summary = summarize_chapter(pdf_path, api_key, model)
+        with open(md_path, "w", encoding="utf-8") as f:
+            f.write(summary)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+        futures = {pool.submit(work, job): job for job in jobs}
+        for future in as_completed(futures):
+            i, _, filename, md_path = futures[future]
+            try:
+                future.result()
+                print(f"  [{i}/{total}] 完成: {filename} → {os.path.basename(md_path)}")
+            except Exception as e:
+                print(f"  [{i}/{total}] 失败: {filename}: {e}")
+                failures.append(filename)
+    return failures
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="批量上传章节 PDF 至 Gemini 获取总结",
@@ -99,7 +334,7 @@ def main():
         sys.exit(1)
 
     # 收集并排序 PDF 文件
-    pdf_files = sorted(glob.glob(os.path.join(args.input_dir, "*.pdf")), key=natural_sort_key)
+    pdf_files = list_chapter_pdfs(args.input_dir)
     if not pdf_files:
         print(f"错误: {args.input_dir} 中没有 PDF 文件")
         sys.exit(1)
@@ -122,34 +357,14 @@ def main():
     print(f"从第 {args.start_from} 个文件开始")
     print("=" * 50)
 
-    for i, pdf_path in enumerate(pdf_files, start=1):
-        filename = os.path.basename(pdf_path)
-        md_name = os.path.splitext(filename)[0] + ".md"
-        md_path = os.path.join(args.output_dir, md_name)
-
-        # 跳过断点续传之前的文件
-        if i < args.start_from:
-            print(f"  [{i}/{total}] 跳过: {filename}")
-            continue
-
-        # 跳过已存在的总结
-        if os.path.isfile(md_path):
-            print(f"  [{i}/{total}] 已存在，跳过: {md_name}")
-            continue
-
-        print(f"  [{i}/{total}] 处理中: {filename} ...", end=" ", flush=True)
-
-        try:
-            summary = summarize_chapter(pdf_path, api_key, args.model, prompt)
-            with open(md_path, "w", encoding="utf-8") as f:
-                f.write(summary)
-            print(f"完成 → {md_name}")
-        except Exception as e:
-            print(f"失败: {e}")
-            print(f"    可用 --start-from {i} 从此处重试")
-            sys.exit(1)
+    failures = run_summaries(pdf_files, args.output_dir, api_key, args.model,
+                             prompt, start_from=args.start_from)
 
     print("\n" + "=" * 50)
+    if failures:
+        print(f"{len(failures)} 章失败: {', '.join(failures)}")
+        print("重新运行即可重试（已完成的章节会自动跳过）。")
+        sys.exit(1)
     print(f"全部完成！总结文件保存在: {args.output_dir}")
 
 
@@ -0,0 +1,52 @@
+"""首页目录列表缓存的回归测试。
+
+核心不变量：应用自身写元数据（索引缓存、打开记录）不能扰动
+目录 mtime 签名，否则缓存永远无法命中。
+"""
+
+import importlib
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("fitz")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """在临时目录下导入 app 模块（BASE_DIR 在导入时取 cwd）。"""
+    monkeypatch.chdir(tmp_path)
+    for name in ("app", "main", "split_chapters"):
+        sys.modules.pop(name, None)
+    module = importlib.import_module("app")
+    yield module
+    sys.modules.pop("app", None)
+
+
+def test_signature_survives_own_metadata_writes(app_module, tmp_path):
+    (tmp_path / "book.pdf").write_bytes(b"%PDF-1.4\n")
+
+    sig = app_module._tree_signature(app_module.BASE_DIR)
+    app_module._save_index_cache(sig, ["book.pdf"])
+    app_module._save_last_opened({"book.pdf": "2026-01-01 00:00:00"})
+
+    # 写缓存/打开记录之后，签名必须保持不变，磁盘缓存可命中
+    assert app_module._tree_signature(app_module.BASE_DIR) == sig
+    assert app_module._load_index_cache(sig) == ["book.pdf"]
+
+
+def test_back_to_back_requests_hit_cache(app_module, tmp_path, monkeypatch):
+    (tmp_path / "book.pdf").write_bytes(b"%PDF-1.4\n")
+    client = app_module.app.test_client()
+
+    assert client.get("/").status_code == 200
+
+    def fail_on_rescan(base):
+        raise AssertionError("缓存未命中：热请求不应重新扫描目录")
+
+    monkeypatch.setattr(app_module, "_iter_pdfs", fail_on_rescan)
+    assert client.get("/").status_code == 200
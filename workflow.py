@@ -21,20 +21,23 @@ PDF 书籍处理完整工作流
 """
 
 import argparse
-import glob
 import json
 import os
 import platform
 import re
 import subprocess
 import sys
+import threading
 
 from dotenv import load_dotenv
 
 # 导入已有模块的函数
-from main import extract_toc_pages, parse_toc_with_gemini, add_bookmarks
-from split_chapters import split_chapters, get_toc_from_bookmarks
-from summarize import summarize_chapter, natural_sort_key, PROMPTS
+from main import (extract_toc_pages, upload_toc_pdf, parse_toc_with_gemini,
+                  add_bookmarks, save_toc_json)
+import fitz  # pymupdf
+
+from split_chapters import split_chapters
+from summarize import run_summaries, list_chapter_pdfs, PROMPTS
 
 load_dotenv()
 
@@ -94,19 +97,39 @@ def step1_generate_toc(input_pdf: str, toc_start: int, toc_end: int,
     print("─" * 50)
     extract_toc_pages(input_pdf, toc_start, toc_end, toc_pdf)
 
+    # 人工确认目录页的同时，后台提前把文件传给 Gemini 并等它
+    # 处理完，把上传等待和确认时间重叠起来。只做上传：真正的
+    # 解析（生成调用及其进度输出）等确认通过后再开始，既不会
+    # 冲掉终端里的确认提示，也不会在用户否决时白白花一次生成
+    upload_result = {}
+    upload_done = threading.Event()
+
+    def _background_upload():
+        try:
+            upload_result["uploaded"] = upload_toc_pdf(toc_pdf, api_key)
+        except Exception as e:
+            upload_result["error"] = e
+        upload_done.set()
+
+    threading.Thread(target=_background_upload, daemon=True).start()
+
     open_file(toc_pdf)
     if not confirm("请确认目录文档是否正确"):
+        # daemon 线程随进程退出，后台上传的文件 48 小时后服务端自动清理
         print("已终止。")
         sys.exit(0)
 
     # ── 1b: Gemini 解析目录 ──
     print("\n" + "─" * 50)
-    print("步骤 1b: Gemini API 解析目录")
+    print("步骤 1b: Gemini API 解析目录（文件已后台上传）")
     print("─" * 50)
-    toc_data = parse_toc_with_gemini(toc_pdf, api_key, model)
+    upload_done.wait()
+    # 后台上传失败则传 None，parse 内部会同步重新上传
+    toc_data = parse_toc_with_gemini(toc_pdf, api_key, model,
+                                     uploaded=upload_result.get("uploaded"))
 
-    with open(toc_json, "w", encoding="utf-8") as f:
-        json.dump(toc_data, f, ensure_ascii=False, indent=2)
+    save_toc_json(toc_json, toc_data)
+    saved_mtime = os.stat(toc_json).st_mtime_ns
     print(f"解析完成，共 {len(toc_data['toc'])} 条 → {os.path.basename(toc_json)}")
 
     open_file(toc_json)
@@ -114,9 +137,11 @@ def step1_generate_toc(input_pdf: str, toc_start: int, toc_end: int,
         print("已终止。")
         sys.exit(0)
 
-    # 重新读取（用户可能手动修改了 JSON）
-    with open(toc_json, "r", encoding="utf-8") as f:
-        toc_data = json.load(f)
+    # 仅当用户确实手动改过 JSON（mtime 变化）才重新读取
+    if os.stat(toc_json).st_mtime_ns != saved_mtime:
+        print("检测到 JSON 已修改，重新读取...")
+        with open(toc_json, "r", encoding="utf-8") as f:
+            toc_data = json.load(f)
 
     # ── 1c: 写入书签 ──
     print("\n" + "─" * 50)
@@ -142,8 +167,13 @@ def step2_split_chapters(input_pdf: str) -> str:
     print("步骤 2: 拆分章节")
     print("─" * 50)
 
-    toc = get_toc_from_bookmarks(input_pdf)
+    # 只打开一次带书签的 PDF，读书签和拆分共用同一个 Document，
+    # 避免步骤间重复解析整本书
+    doc = fitz.open(input_pdf)
+    raw_toc = doc.get_toc()
+    toc = [{"level": item[0], "title": item[1], "page": item[2]} for item in raw_toc]
     if not toc:
+        doc.close()
         print("错误: PDF 中没有书签，无法拆分。请先执行步骤 1。")
         sys.exit(1)
 
@@ -152,7 +182,8 @@ def step2_split_chapters(input_pdf: str) -> str:
     output_dir = os.path.join(os.path.dirname(input_pdf), book_name)
 
     os.makedirs(output_dir, exist_ok=True)
-    split_chapters(input_pdf, toc, output_dir)
+    split_chapters(input_pdf, toc, output_dir, doc=doc)
+    doc.close()
 
     open_file(output_dir)
     if not confirm("请确认章节划分是否正确"):
@@ -173,7 +204,7 @@ def step3_summarize(chapters_dir: str, prompt_type: str,
     print("步骤 3: 逐章总结")
     print("─" * 50)
 
-    pdf_files = sorted(glob.glob(os.path.join(chapters_dir, "*.pdf")), key=natural_sort_key)
+    pdf_files = list_chapter_pdfs(chapters_dir)
     if not pdf_files:
         print(f"错误: {chapters_dir} 中没有 PDF 文件")
         sys.exit(1)
@@ -193,26 +224,11 @@ def step3_summarize(chapters_dir: str, prompt_type: str,
         print("已终止。")
         sys.exit(0)
 
-    for i, pdf_path in enumerate(pdf_files, start=1):
-        filename = os.path.basename(pdf_path)
-        md_name = os.path.splitext(filename)[0] + ".md"
-        md_path = os.path.join(summary_dir, md_name)
+    failures = run_summaries(pdf_files, summary_dir, api_key, model, prompt)
 
-        if os.path.isfile(md_path):
-            print(f"  [{i}/{total}] 已存在，跳过: {md_name}")
-            continue
-
-        print(f"  [{i}/{total}] 处理中: {filename} ...", end=" ", flush=True)
-
-        try:
-            summary = summarize_chapter(pdf_path, api_key, model, prompt)
-            with open(md_path, "w", encoding="utf-8") as f:
-                f.write(summary)
-            print(f"完成 → {md_name}")
-        except Exception as e:
-            print(f"失败: {e}")
-            print(f"\n已完成 {i-1}/{total}，可修复后重新运行（已有文件会自动跳过）。")
-            sys.exit(1)
+    if failures:
+        print(f"\n{len(failures)} 章失败，可修复后重新运行（已有文件会自动跳过）。")
+        sys.exit(1)
 
     print(f"\n全部完成！总结保存在: {summary_dir}")
 